@@ -1,15 +1,63 @@
 import requests
-import json
-import time 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import os
+import time
+from functools import lru_cache
 from pathlib import Path
 
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+    _JSONDecodeError = orjson.JSONDecodeError
+except ImportError:
+    # Alternativa con la biblioteca estándar si orjson no se puede instalar (p. ej. sin wheel para la plataforma)
+    import json
+    # Salida compacta y UTF-8 como orjson; puede diferir en el formato de algunos floats (1e-07 frente a 1e-7),
+    # pero el JSON es válido y representa los mismos valores
+    _ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    _loads = json.loads
+    _JSONDecodeError = json.JSONDecodeError
+
+    def _dumps(obj):
+        return _ENCODER.encode(obj).encode('utf-8')
+
 # URL de la fuente de datos
 API_URL = "https://sedeaplicaciones.minetur.gob.es/ServiciosRESTCarburantes/PreciosCarburantes/EstacionesTerrestres/"
 OUTPUT_FILE = "gasolineras.geojson"
+# Fichero auxiliar con el ETag y el Last-Modified de la última descarga (para evitar reprocesar datos sin cambios)
+ETAG_FILE = ".gasolineras.etag"
 
-# Configuración de reintentos
+# Configuración de reintentos (espera exponencial gestionada por urllib3: 0s, 2s, 4s, 8s, 16s y después
+# 30s como máximo; en total unos 180s de espera en el peor caso)
 MAX_RETRIES = 10
-RETRY_DELAY_SECONDS = 20 
+RETRY_BACKOFF_FACTOR = 1
+RETRY_BACKOFF_MAX = 30
+# Intentos completos de descarga: la lectura del cuerpo y su decodificación quedan fuera del Retry de urllib3
+DOWNLOAD_ATTEMPTS = 3
+RETRY_DELAY_SECONDS = 20
+
+# --- CABECERA USER-AGENT para simular un navegador y evitar bloqueos de IP ---
+# Accept-Encoding se fija explícitamente para que la respuesta (~15 MB de JSON) llegue comprimida
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept-Encoding': 'gzip, deflate',
+}
+
+# Sesión reutilizable: mantiene la conexión abierta (keep-alive) entre reintentos
+_RETRY = Retry(
+    total=MAX_RETRIES,
+    backoff_factor=RETRY_BACKOFF_FACTOR,
+    backoff_max=RETRY_BACKOFF_MAX,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET"],
+    # Retry-After podría imponer esperas sin límite; se usa siempre la espera acotada de arriba
+    respect_retry_after_header=False,
+)
+_SESSION = requests.Session()
+_SESSION.headers.update(HEADERS)
+_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=_RETRY))
 
 # Mapeo de nombres de campos del JSON original a nombres simplificados y normalizados
 PRECIOS_MAP = {
@@ -21,51 +69,141 @@ PRECIOS_MAP = {
     "Precio Gasolina 95 E10": "Precio_95E10",
     "Precio Gasolina 98 E10": "Precio_98E10",
 }
+# Pares (clave original, clave nueva) precalculados para recorrerlos en el bucle principal
+_PRECIOS_ITEMS = tuple(PRECIOS_MAP.items())
 
+# Tabla de traducción para cambiar la coma decimal por punto en una sola pasada
+_COMMA_TBL = str.maketrans(',', '.')
+
+# Los precios se repiten mucho entre estaciones: se memorizan las conversiones
+# (las coordenadas son casi únicas por estación, así que no se cachean)
+@lru_cache(maxsize=4096)
 def clean_price(price_str):
     """Limpia una cadena de precio y la convierte a float. Devuelve None si no es válido."""
-    if not price_str or price_str.strip() == "":
+    s = price_str and price_str.strip()
+    if not s:
         return None
     try:
         # Reemplaza la coma por el punto para la conversión a float
-        return float(price_str.replace(',', '.'))
+        return float(s.translate(_COMMA_TBL))
     except ValueError:
         return None
 
 def clean_coord(coord_str):
     """Limpia y convierte las coordenadas a float."""
-    if not coord_str:
+    s = coord_str and coord_str.strip()
+    if not s:
         return None
     try:
-        return float(coord_str.replace(',', '.').strip())
+        return float(s.translate(_COMMA_TBL))
     except ValueError:
         return None
 
+def read_cache_headers():
+    """Devuelve las cabeceras condicionales (If-None-Match / If-Modified-Since) de la última descarga."""
+    cache_path = Path(ETAG_FILE)
+    if not cache_path.is_file() or not Path(OUTPUT_FILE).is_file():
+        return {}
+    try:
+        saved = _loads(cache_path.read_bytes())
+    except _JSONDecodeError:
+        return {}
+    if not isinstance(saved, dict):
+        return {}
+    headers = {}
+    if saved.get('etag'):
+        headers['If-None-Match'] = saved['etag']
+    if saved.get('last_modified'):
+        headers['If-Modified-Since'] = saved['last_modified']
+    return headers
+
+def save_cache_headers(response):
+    """Guarda de forma atómica el ETag y el Last-Modified de la respuesta (vacíos si el servidor no los envía)."""
+    validators = {
+        'etag': response.headers.get('ETag', ''),
+        'last_modified': response.headers.get('Last-Modified', ''),
+    }
+    tmp = ETAG_FILE + '.tmp'
+    Path(tmp).write_bytes(_dumps(validators) + b'\n')
+    os.replace(tmp, ETAG_FILE)
+
+def iter_features(estaciones):
+    """Genera, una a una, las features GeoJSON de las estaciones con coordenadas y algún precio válido."""
+    for estacion in estaciones:
+        estacion_get = estacion.get
+        # La API usa 'Longitud (WGS84)' para la longitud y 'Latitud' para la latitud
+        lat = clean_coord(estacion_get("Latitud"))
+        lon = clean_coord(estacion_get("Longitud (WGS84)"))
+        
+        # Debe tener coordenadas válidas
+        if lat is None or lon is None:
+            continue
+        
+        # Descarta las estaciones sin ningún precio publicado antes de construir sus propiedades
+        raw_prices = [estacion_get(original_key) for original_key, _ in _PRECIOS_ITEMS]
+        if not any(p and p.strip() for p in raw_prices):
+            continue
+            
+        properties = {
+            "Rotulo": estacion_get("Rótulo", "S/N"),
+            "Direccion": estacion_get("Dirección", ""),
+        }
+        
+        has_valid_price = False
+        for (_, new_key), raw_price in zip(_PRECIOS_ITEMS, raw_prices):
+            price = clean_price(raw_price)
+            properties[new_key] = price
+            if price is not None:
+                has_valid_price = True
+        
+        # Solo añade la estación si tiene al menos un precio válido (para reducir el tamaño del archivo)
+        if has_valid_price:
+            yield {
+                "type": "Feature",
+                "geometry": {
+                    # GeoJSON usa [longitud, latitud]
+                    "coordinates": [lon, lat],
+                    "type": "Point"
+                },
+                "properties": properties
+            }
+
 def process_data():
     """Descarga los datos de la API, limpia y genera el GeoJSON con reintentos."""
     print("1. Descargando datos de la API del Ministerio...")
     
-    # --- CABECERA USER-AGENT para simular un navegador y evitar bloqueos de IP ---
-    HEADERS = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
+    # Petición condicional: si los datos no han cambiado, la API responde 304 sin cuerpo
+    request_headers = read_cache_headers() or None
     
     data = None
-    # Lógica de Reintentos
-    for attempt in range(MAX_RETRIES):
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        print(f"Intento {attempt} de {DOWNLOAD_ATTEMPTS}...")
         try:
-            print(f"Intento {attempt + 1} de {MAX_RETRIES}...")
-            # Realizar la petición, pasando la cabecera y el timeout
-            response = requests.get(API_URL, timeout=45, headers=HEADERS) 
+            # Realizar la petición con la sesión compartida (cabecera, timeout y reintentos incluidos).
+            # Con stream=True la llamada vuelve al recibir las cabeceras: los errores de conexión y de
+            # estado HTTP ya los ha reintentado urllib3, así que si fallan aquí no se vuelve a intentar
+            response = _SESSION.get(API_URL, timeout=45, headers=request_headers, stream=True)
+            if response.status_code == 304:
+                response.close()
+                print("Los datos no han cambiado desde la última descarga (304). No se regenera el GeoJSON.")
+                return
             response.raise_for_status()
-            data = response.json()
-            print("Descarga exitosa.")
-            break # Salir del bucle si la descarga es exitosa
         except requests.exceptions.RequestException as e:
             print(f"Error en la descarga (Tipo: {e.__class__.__name__}): {e}")
+            break
+        
+        with response:
+            try:
+                # response.content ya son los bytes descomprimidos: se evita decodificar a texto (.text)
+                # Un corte de conexión durante la lectura o un cuerpo truncado se reintentan en este bucle
+                data = _loads(response.content)
+                print("Descarga exitosa.")
+                break
+            except (requests.exceptions.RequestException, _JSONDecodeError) as e:
+                print(f"Error en la descarga (Tipo: {e.__class__.__name__}): {e}")
         
         # Esperar y reintentar si no es el último intento
-        if attempt < MAX_RETRIES - 1:
+        if attempt < DOWNLOAD_ATTEMPTS:
             print(f"Esperando {RETRY_DELAY_SECONDS} segundos antes de reintentar...")
             time.sleep(RETRY_DELAY_SECONDS)
 
@@ -77,55 +215,42 @@ def process_data():
     # Procesamiento de datos si la descarga fue exitosa
     # ----------------------------------------------------
     estaciones = data.get("ListaEESSPrecio", [])
-    features = []
+    num_features = 0
     
     print(f"2. Procesando {len(estaciones)} estaciones de servicio...")
     
-    for estacion in estaciones:
-        # La API usa 'Longitud (WGS84)' para la longitud y 'Latitud' para la latitud
-        lat = clean_coord(estacion.get("Latitud"))
-        lon = clean_coord(estacion.get("Longitud (WGS84)"))
-        
-        # Debe tener coordenadas válidas
-        if lat is None or lon is None:
-            continue
-            
-        properties = {
-            "Rotulo": estacion.get("Rótulo", "S/N"),
-            "Direccion": estacion.get("Dirección", ""),
-        }
+    # El GeoJSON se escribe en streaming, estación a estación, sin construir la lista completa en memoria
+    # Se genera UTF-8 sin escapar (equivalente a ensure_ascii=False)
+    # Se escribe en un temporal con búfer de 1 MB y se renombra al final, para que el frontend
+    # nunca lea un archivo a medio escribir
+    tmp_file = OUTPUT_FILE + '.tmp'
+    try:
+        with open(tmp_file, 'wb', buffering=1 << 20) as f:
+            f.write(b'{"type":"FeatureCollection","features":[\n')
         
-        has_valid_price = False
-        for original_key, new_key in PRECIOS_MAP.items():
-            price = clean_price(estacion.get(original_key))
-            properties[new_key] = price
-            if price is not None:
-                has_valid_price = True
+            for feature in iter_features(estaciones):
+                # Separador entre features (no antes de la primera)
+                if num_features:
+                    f.write(b',\n')
+                # Salida compacta, una estación por línea (el frontend no necesita indentación)
+                f.write(_dumps(feature))
+                num_features += 1
         
-        # Solo añade la estación si tiene al menos un precio válido (para reducir el tamaño del archivo)
-        if has_valid_price:
-            feature = {
-                "type": "Feature",
-                "geometry": {
-                    # GeoJSON usa [longitud, latitud]
-                    "coordinates": [lon, lat],
-                    "type": "Point"
-                },
-                "properties": properties
-            }
-            features.append(feature)
+            f.write(b'\n]}\n')
+        os.replace(tmp_file, OUTPUT_FILE)
+    except BaseException:
+        # No dejar el temporal a medio escribir en el directorio de trabajo
+        Path(tmp_file).unlink(missing_ok=True)
+        raise
 
-    geojson = {
-        "type": "FeatureCollection",
-        "features": features
-    }
+    # Guardar ETag / Last-Modified solo cuando el GeoJSON se ha escrito correctamente.
+    # El fichero se escribe siempre (aunque vaya vacío) para que el paso de commit del workflow lo encuentre
+    save_cache_headers(response)
 
-    # Guardar el GeoJSON
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        # Usar indent=2 para hacer el GeoJSON legible, pero puedes quitarlo si quieres el archivo más pequeño
-        json.dump(geojson, f, ensure_ascii=False, indent=2)
+    # Liberar la memoria de la caché de conversión de precios
+    clean_price.cache_clear()
         
-    print(f"3. Proceso finalizado. {len(features)} estaciones guardadas en '{OUTPUT_FILE}'.")
+    print(f"3. Proceso finalizado. {num_features} estaciones guardadas en '{OUTPUT_FILE}'.")
 
 if __name__ == "__main__":
     process_data()